@@ -1,8 +1,11 @@
 import sys
 
-from math import inf
+from collections import Counter, deque
+from functools import lru_cache
+from multiprocessing import Process, Queue
+from queue import Empty
+from traceback import format_exc
 from crossword import *
-from copy import deepcopy
 
 BACKTRACK_COUNTER = 0
 WORDS_TESTED = 0
@@ -14,25 +17,67 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+        self._length = {
+            var: var.length
+            for var in self.crossword.variables
+        }
+
+        # Group the vocabulary by length in a single pass
+        words_by_len = {length: set() for length in self._length.values()}
+        for word in self.crossword.words:
+            if len(word) in words_by_len:
+                words_by_len[len(word)].add(word)
+        self._words_by_len = {
+            length: frozenset(words) for length, words in words_by_len.items()
+        }
+
+        # Domains are frozen, so variables of equal length share one set
         self.domains = {
-            var: self.crossword.words.copy()
+            var: self._words_by_len[self._length[var]]
             for var in self.crossword.variables
         }
 
+        # Stack of (variable, previous domain) pairs, rewound on backtrack
+        self._trail = []
+
+        # Maps words used by the assignment being searched to their variable
+        self._used = dict()
+
+        # Memoized value orderings, see order_domain_values
+        self._ordered_values = lru_cache(maxsize=4096)(self.order_values)
+
+        # Maps (variable, index, letter) to the words of that variable's
+        # domain with the letter at the index, see build_letter_index
+        self._by_letter = dict()
+
+        # Maps (variable, index, letter) to how many of those words are
+        # still in the domain, see build_letter_index and count_supports
+        self._counts = dict()
+
+        # Cache constraint graph lookups used inside the search loops
+        self._arc_idx = {
+            arc: overlap
+            for arc, overlap in self.crossword.overlaps.items()
+            if overlap
+        }
+
+        # Neighbors come straight from the overlapping arcs, rather than
+        # rescanning every variable pair once per variable
+        neighbors = {var: set() for var in self.crossword.variables}
+        for x, y in self._arc_idx:
+            neighbors[x].add(y)
+        self._neighbors = {
+            var: frozenset(others) for var, others in neighbors.items()
+        }
+
     def letter_grid(self, assignment):
         """
-        Return 2D array representing a given assignment.
+        Return dict mapping (i, j) cells to letters of a given assignment.
         """
-        letters = [
-            [None for _ in range(self.crossword.width)]
-            for _ in range(self.crossword.height)
-        ]
+        letters = dict()
         for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
+            for cell, letter in zip(variable.cells, word):
+                letters[cell] = letter
         return letters
 
     def print(self, assignment):
@@ -43,7 +88,7 @@ class CrosswordCreator():
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
                 if self.crossword.structure[i][j]:
-                    print(letters[i][j] or " ", end="")
+                    print(letters.get((i, j), " "), end="")
                 else:
                     print("█", end="")
             print()
@@ -68,8 +113,10 @@ class CrosswordCreator():
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
-        for i in range(self.crossword.height):
-            for j in range(self.crossword.width):
+        for i, row in enumerate(self.crossword.structure):
+            for j, open_cell in enumerate(row):
+                if not open_cell:
+                    continue
 
                 rect = [
                     (j * cell_size + cell_border,
@@ -77,194 +124,358 @@ class CrosswordCreator():
                     ((j + 1) * cell_size - cell_border,
                      (i + 1) * cell_size - cell_border)
                 ]
-                if self.crossword.structure[i][j]:
-                    draw.rectangle(rect, fill="white")
-                    if letters[i][j]:
-                        w, h = draw.textsize(letters[i][j], font=font)
-                        draw.text(
-                            (rect[0][0] + ((interior_size - w) / 2),
-                             rect[0][1] + ((interior_size - h) / 2) - 10),
-                            letters[i][j], fill="black", font=font
-                        )
+                draw.rectangle(rect, fill="white")
+                letter = letters.get((i, j))
+                if letter:
+                    w, h = draw.textsize(letter, font=font)
+                    draw.text(
+                        (rect[0][0] + ((interior_size - w) / 2),
+                         rect[0][1] + ((interior_size - h) / 2) - 10),
+                        letter, fill="black", font=font
+                    )
 
         img.save(filename)
 
-    def solve(self, interleaving):
+    def solve(self, interleaving, workers=1):
         """
         Enforce node and arc consistency, and then solve the CSP.
+
+        With more than one worker, the search is split across processes
+        on the values of the first variable, see `solve_parallel`.
         """
         self.enforce_node_consistency()
-        self.ac3()
+        self.build_letter_index()
+        self.ac4()
         if not interleaving:
             print('Solving Crossword with single arc consistency enforcement...')
-            return self.backtrack(dict())
         else:
             print('Solving Crossword with interleaved backtracking and arc consistency enforcement...')
+
+        if workers > 1:
+            return self.solve_parallel(interleaving, workers)
+        elif not interleaving:
+            return self.backtrack(dict())
+        else:
             return self.backtrack_ac3(dict())
 
+    def solve_parallel(self, interleaving, workers):
+        """
+        Partition the domain of the first variable the search would pick
+        into `workers` disjoint chunks and search each in its own process.
+
+        Returns the first assignment found, or None if no chunk has one.
+        """
+        global BACKTRACK_COUNTER
+        global WORDS_TESTED
+
+        if self.assignment_complete(dict()):
+            return dict()
+
+        # Deal values out round-robin so every worker starts on a good value
+        variable = self.select_unassigned_variable(dict())
+        values = self.order_domain_values(variable, dict())
+        chunks = [values[k::workers] for k in range(workers) if values[k::workers]]
+        if not chunks:
+            return None
+
+        results = Queue()
+        processes = [
+            Process(
+                target=_solve_with_seed,
+                args=(self.crossword, interleaving, variable, chunk, index, results)
+            )
+            for index, chunk in enumerate(chunks)
+        ]
+        for process in processes:
+            process.start()
+
+        try:
+            reported = set()
+            while len(reported) < len(processes):
+                try:
+                    index, assignment, backtracks, tested, error = results.get(timeout=1)
+                except Empty:
+                    # A worker flushes its report before exiting, so one that
+                    # exited with nothing left on the queue died without it
+                    for index, process in enumerate(processes):
+                        if index not in reported and process.exitcode is not None:
+                            if results.empty():
+                                raise RuntimeError(
+                                    f"Worker {index} exited with code "
+                                    f"{process.exitcode} without reporting"
+                                )
+                    continue
+
+                reported.add(index)
+                BACKTRACK_COUNTER += backtracks
+                WORDS_TESTED += tested
+                if error:
+                    raise RuntimeError(f"Worker {index} failed:\n{error}")
+                if assignment:
+                    return assignment
+            return None
+        finally:
+            # Stop workers still searching other chunks
+            for process in processes:
+                process.terminate()
+                process.join()
+
     def enforce_node_consistency(self):
 
-        # Iterate through all domains
-        for domain in self.domains:
-            domain_lengrh = domain.length
-            to_remove = set()
+        # Domains start out as the words of matching length, so only drop
+        # words from any domain that has since been set some other way
+        for var in self.domains:
+            length = self._length[var]
+            if any(len(val) != length for val in self.domains[var]):
+                self.domains[var] = frozenset(
+                    val for val in self.domains[var] if len(val) == length
+                )
 
-            # Iterate through all values in the domain
-            for val in self.domains[domain]:
-                # If value length does not match domain length, add to values to remove
-                if len(val) != domain_lengrh:
-                    to_remove.add(val)
+    def build_letter_index(self):
+        """
+        Index every node consistent domain by (variable, index, letter).
 
-            # Remove all invalide vals from domain
-            self.domains[domain] = self.domains[domain] - to_remove
+        The index is never pruned: callers intersect a bucket with the
+        current domain, so it stays valid as domains shrink and are
+        restored from the trail. The support counts start out as the
+        bucket sizes and follow the domains from then on.
+        """
+        by_letter = dict()
+        for var in self.domains:
+            for val in self.domains[var]:
+                for index, letter in enumerate(val):
+                    by_letter.setdefault((var, index, letter), set()).add(val)
+
+        self._by_letter = {
+            key: frozenset(words) for key, words in by_letter.items()
+        }
+        self._counts = {
+            key: len(words) for key, words in by_letter.items()
+        }
 
-    def overlap_satisfied(self, x, y, val_x, val_y):
-            """
-            Helper function that returns true if val_x and val_y
-            satisfy any overlap arc consistency requirement for
-            variables x and y.
+    def count_supports(self, var, values, delta):
+        """
+        Add `delta` to the support counts of every letter of `values`.
+        """
+        for val in values:
+            for index, letter in enumerate(val):
+                self._counts[var, index, letter] += delta
 
-            Returns True if consistency is satisfied, False otherwise.
-            """
+    def remove_values(self, var, values):
+        """
+        Remove `values` from the domain of `var`, recording the old domain
+        on the trail and keeping the support counts in step.
+        """
+        self._trail.append((var, self.domains[var]))
+        self.domains[var] = self.domains[var] - values
+        self.count_supports(var, values, -1)
 
-            # If no overlap, no arc consistency to satisfy
-            if not self.crossword.overlaps[x, y]:
-                return True
+    def supported(self, y, index_x, index_y, val_x, same_length):
+        """
+        Return True if some word in the domain of y, other than val_x
+        itself, has val_x's letter at `index_x` at its own `index_y`.
+        """
+        letter = val_x[index_x]
+        count = self._counts.get((y, index_y, letter), 0)
 
-            # Otherwise check that letters match at overlapping indices
-            else:
-                index_x, index_y = self.crossword.overlaps[x,y]
+        # A word cannot support itself, since every word is used only once;
+        # that can only happen when x and y have the same length
+        if same_length and val_x in self.domains[y] and val_x[index_y] == letter:
+            count -= 1
+        return count > 0
 
-                if val_x[index_x] == val_y[index_y]:
-                    return True
-                else:
-                    return False
-
-    def revise(self, x, y):
-        revision = False
-        to_remove = set()
-
-        # Iterate over domains x and y, track any inconsistentcy
-        for val_x in self.domains[x]:
-            consistent = False
-            for val_y in self.domains[y]:
-                if val_x != val_y and self.overlap_satisfied(x, y, val_x, val_y):
-                    consistent = True
-                    break
-
-            if not consistent:
-                to_remove.add(val_x)
-                revision = True
-
-        # Remove any domain variables that aren't consistent:
-        self.domains[x] = self.domains[x] - to_remove
-        return revision
-
-    def ac3(self, arcs=None):
-        # If no arcs, start with queue of all arcs:
-        if not arcs:
-            arcs = []
-            for domain_1 in self.domains:
-                for domain_2 in self.domains:
-                    if domain_1 != domain_2:
-                        arcs.append((domain_1, domain_2))
-
-        # Continue until no arcs left (arc consistency enforced):
-        while arcs:
-            domain_x, domain_y = arcs.pop()
-            # Revise x domain and y:
-            if self.revise(domain_x, domain_y):
-                # If x domain is empty after revision, no solution:
-                if not self.domains[domain_x]:
-                    return False
-                # If revised, add to arcs all x neighbors
-                for domain_z in self.crossword.neighbors(domain_x) - {domain_y}:
-                    arcs.append((domain_z, domain_x))
+    def ac4(self, removed=None):
+        """
+        Enforce arc consistency using AC-4 style support counts.
+
+        Every word in y with a given letter at the overlap supports the
+        same words in x, so supports are counted per (variable, index,
+        letter) rather than per word. If `removed` is None, every value
+        is checked against every overlapping arc first; otherwise only
+        the given (variable, removed values) pairs are propagated.
+
+        Returns False if some domain becomes empty, True otherwise.
+        """
+        queue = deque()
+
+        # Start by dropping values without support on any overlapping arc
+        if removed is None:
+            for (x, y), (index_x, index_y) in self._arc_idx.items():
+                same_length = self._length[x] == self._length[y]
+                unsupported = {
+                    val_x for val_x in self.domains[x]
+                    if not self.supported(y, index_x, index_y, val_x, same_length)
+                }
+                if unsupported:
+                    self.remove_values(x, unsupported)
+                    if not self.domains[x]:
+                        return False
+                    queue.append((x, unsupported))
+        else:
+            queue.extend(removed)
+
+        # Continue until no removals are left to propagate:
+        while queue:
+            y, values = queue.popleft()
+            for x in self._neighbors[y]:
+                index_x, index_y = self._arc_idx[x, y]
+                same_length = self._length[x] == self._length[y]
+
+                # Only letters down to their last support can cost x values
+                letters = {
+                    val[index_y] for val in values
+                    if self._counts[y, index_y, val[index_y]] <= 1
+                }
+                unsupported = set()
+                for letter in letters:
+                    bucket = self._by_letter.get((x, index_x, letter), frozenset())
+                    for val_x in bucket & self.domains[x]:
+                        if not self.supported(y, index_x, index_y, val_x, same_length):
+                            unsupported.add(val_x)
+
+                if unsupported:
+                    self.remove_values(x, unsupported)
+                    # If x domain is empty after removal, no solution:
+                    if not self.domains[x]:
+                        return False
+                    queue.append((x, unsupported))
         return True
 
+    def undo(self, mark):
+        """
+        Restore every domain recorded on the trail since position `mark`.
+        """
+        while len(self._trail) > mark:
+            variable, domain = self._trail.pop()
+            self.count_supports(variable, domain - self.domains[variable], 1)
+            self.domains[variable] = domain
+
     def assignment_complete(self, assignment):
         for domain in self.domains:
             if domain not in assignment:
                 return False
         return True
 
-    def consistent(self, assignment):
-        processed = []
+    def consistent_add(self, assignment, var, value):
+        """
+        Return True if assigning `value` to `var` keeps a consistent
+        `assignment` consistent, checking only the constraints on `var`.
+        """
 
-        for variable_x in assignment:
-            value_x = assignment[variable_x]
+        # If the word has the wrong length, not consistent:
+        if len(value) != self._length[var]:
+            return False
 
-            # If the assigned word is already used, not consistent:
-            if value_x in processed:
-                return False
-            processed.append(value_x)
+        return self.find_conflict(assignment, var, value) is None
 
-            # Check if variable is assigned its length is correct
-            if len(value_x) != variable_x.length:
-                return False
+    def find_conflict(self, assignment, var, value):
+        """
+        Return an assigned variable that rules out assigning `value` to
+        `var`, or None if there is no such variable.
+        """
 
-            # Check if there are conflicts between neighboring variables:
-            for variable_y in self.crossword.neighbors(variable_x):
-                if variable_y in assignment:
-                    value_y = assignment[variable_y]
+        # If the word is already used, it conflicts with its variable:
+        if value in self._used:
+            return self._used[value]
 
-                    # Check if neighbor variable is assigned and satisfies constraints
-                    if not self.overlap_satisfied(variable_x, variable_y, value_x, value_y):
-                        return False
+        # Check for conflicts with assigned neighboring variables only:
+        for other_var in self._neighbors[var]:
+            if other_var in assignment:
+                index_var, index_other = self._arc_idx[var, other_var]
+                if value[index_var] != assignment[other_var][index_other]:
+                    return other_var
 
-        # all assignments are consistent
-        return True
+        return None
 
     def order_domain_values(self, var, assignment):
 
-        values_ruleout = {val: 0 for val in self.domains[var]}
+        # Orderings only depend on the domains involved, and undo restores
+        # the very same frozensets, so identical states hit the cache
+        neighbor_domains = tuple(
+            (other_var, self.domains[other_var])
+            for other_var in self._neighbors[var]
+            if other_var not in assignment
+        )
+        return self._ordered_values(var, self.domains[var], neighbor_domains)
 
-        # Iterate through all possible values of var:
-        for value in self.domains[var]:
+    def order_values(self, var, domain, neighbor_domains):
+        """
+        Return the values of `domain` sorted from fewest to most values
+        ruled out in the domains of the (neighbor, domain) pairs given.
+        """
 
-            # Iterate through neighboring variables and values:
-            for other_var in self.crossword.neighbors(var):
-                for other_val in self.domains[other_var]:
+        # Count letters at each overlapping position of the neighbors
+        histograms = []
+        for other_var, other_domain in neighbor_domains:
+            index_var, index_other = self._arc_idx[var, other_var]
+            letters = Counter(val[index_other] for val in other_domain)
+            histograms.append((index_var, len(other_domain), letters))
+
+        # A value rules out every neighbor value without its overlapping letter
+        values_ruleout = {
+            value: sum(
+                size - letters[value[index_var]]
+                for index_var, size, letters in histograms
+            )
+            for value in domain
+        }
 
-                    # If value rules out other value, add to ruled_out count
-                    if not self.overlap_satisfied(var, other_var, value, other_val):
-                        values_ruleout[value] += 1
+        # Return vals sorted from fewest to most other_vals ruled out:
+        return tuple(sorted(values_ruleout, key=lambda x: values_ruleout[x]))
 
-        # Return list of vals sorted from fewest to most other_vals ruled out:
-        return sorted([x for x in values_ruleout], key = lambda x: values_ruleout[x])
     def select_unassigned_variable(self, assignment):
 
+        # Get unassigned variables
+        unassigned = (var for var in self.domains if var not in assignment)
 
-        # Get set of unassigned variables
-        unassigned = set(self.domains.keys()) - set(assignment.keys())
-
-        # Create list of variables, sorted by MRV and highest degree
-        result = [var for var in unassigned]
-        result.sort(key = lambda x: (len(self.domains[x]), -len(self.crossword.neighbors(x))))
-
-        return result[0]
+        # Pick the variable with MRV, breaking ties by highest degree
+        return min(unassigned, key=lambda x: (len(self.domains[x]), -len(self._neighbors[x])))
 
     def backtrack(self, assignment):
+        result, _ = self.backjump(assignment)
+        return result
+
+    def backjump(self, assignment):
+        """
+        Search with conflict-directed backjumping.
 
+        Returns the completed assignment and an empty set, or None and
+        the conflict set: the assigned variables that ruled out values
+        somewhere in this subtree. A caller not in the conflict set
+        cannot repair the failure, so it passes the set straight up.
+        """
         global BACKTRACK_COUNTER
         global WORDS_TESTED
         BACKTRACK_COUNTER += 1
 
         # If all variables are assigned, return assignment:
         if self.assignment_complete(assignment):
-            return assignment
+            return assignment, set()
 
         # Otherwise select an unassigned variable:
         variable = self.select_unassigned_variable(assignment)
+        conflict_set = set()
         for value in self.order_domain_values(variable, assignment):
-            assignment[variable] = value
             WORDS_TESTED += 1
-            if self.consistent(assignment):
-                result = self.backtrack(assignment)
-                if result:
-                    return result
+            conflict = self.find_conflict(assignment, variable, value)
+            if conflict is not None:
+                conflict_set.add(conflict)
+                continue
+
+            assignment[variable] = value
+            self._used[value] = variable
+            result, child_conflicts = self.backjump(assignment)
+            if result:
+                return result, set()
             del assignment[variable]
-        return None
+            del self._used[value]
+
+            # If this variable played no part in the failure, jump back
+            if variable not in child_conflicts:
+                return None, child_conflicts
+            conflict_set |= child_conflicts - {variable}
+
+        return None, conflict_set
 
     def backtrack_ac3(self, assignment):
         global BACKTRACK_COUNTER
@@ -277,39 +488,90 @@ class CrosswordCreator():
 
         # Otherwise select an unassigned variable:
         variable = self.select_unassigned_variable(assignment)
-        domains_copy = deepcopy(self.domains)
         for value in self.order_domain_values(variable, assignment):
-            assignment[variable] = value
             WORDS_TESTED += 1
-            if self.consistent(assignment):
+            if self.consistent_add(assignment, variable, value):
+                # Remember trail position so domain reductions can be undone
+                mark = len(self._trail)
+                assignment[variable] = value
+                self._used[value] = variable
                 # Update variable domain to be assigned value
-                self.domains[variable] = {value}
-                # Use ac3 to remove inconcistent values from neighbouring variables
-                self.ac3([(other_var, variable) for other_var in self.crossword.neighbors(variable)])
-                result = self.backtrack_ac3(assignment)
-                if result:
-                    return result
-            # If assignment does not produce solution, remove assignment and reset domains
-            del assignment[variable]
-            self.domains = domains_copy
+                others = self.domains[variable] - {value}
+                self.remove_values(variable, others)
+                # Use ac4 to remove inconcistent values from neighbouring variables
+                if self.ac4([(variable, others)]):
+                    result = self.backtrack_ac3(assignment)
+                    if result:
+                        return result
+                # If assignment does not produce solution, remove assignment and reset domains
+                del assignment[variable]
+                del self._used[value]
+                self.undo(mark)
         return None
 
+def _solve_with_seed(crossword, interleaving, variable, values, index, results):
+    """
+    Solve `crossword` with the domain of `variable` restricted to `values`.
+
+    Runs as worker `index` of `CrosswordCreator.solve_parallel` and puts
+    the assignment (or None), this search's counters and the traceback of
+    any error on `results`.
+    """
+    global BACKTRACK_COUNTER
+    global WORDS_TESTED
+
+    # Count each subproblem from zero, whatever the parent had counted
+    BACKTRACK_COUNTER = 0
+    WORDS_TESTED = 0
+
+    assignment = None
+    try:
+        creator = CrosswordCreator(crossword)
+        creator.enforce_node_consistency()
+        creator.build_letter_index()
+        creator.remove_values(variable, creator.domains[variable] - set(values))
+
+        if creator.ac4():
+            if not interleaving:
+                assignment = creator.backtrack(dict())
+            else:
+                assignment = creator.backtrack_ac3(dict())
+    except Exception:
+        # Hand the error to the parent, which stops the other workers
+        results.put((index, None, BACKTRACK_COUNTER, WORDS_TESTED, format_exc()))
+        return
+    results.put((index, assignment, BACKTRACK_COUNTER, WORDS_TESTED, None))
+
+
 def main():
 
+    usage = "Usage: python generate.py structure words interleaving [output] [--workers N]"
+    args = sys.argv[1:]
+
+    # Take the optional worker count out before the positional arguments
+    workers = 1
+    if "--workers" in args:
+        position = args.index("--workers")
+        try:
+            workers = int(args[position + 1])
+        except (IndexError, ValueError):
+            sys.exit(usage)
+        del args[position:position + 2]
+
     # Check usage
-    if len(sys.argv) not in [4, 5]:
-        sys.exit("Usage: python generate.py structure words interleaving [output]")
+    if len(args) not in [3, 4]:
+        sys.exit(usage)
 
     # Parse command-line arguments
-    structure = sys.argv[1]
-    words = sys.argv[2]
-    interleaving = sys.argv[3] == 'True'
-    output = sys.argv[4] if len(sys.argv) == 5 else None
+    structure = args[0]
+    words = args[1]
+    interleaving = args[2] == 'True'
+    output = args[3] if len(args) == 4 else None
 
     # Generate crossword
     crossword = Crossword(structure, words)
     creator = CrosswordCreator(crossword)
-    assignment = creator.solve(interleaving)
+    assignment = creator.solve(interleaving, workers)
 
     # Print result
     if assignment is None: